@@ -1,20 +1,25 @@
 import asyncio
 import datetime
+import functools
 import logging
 import random
+import sys
 
 import aiohttp
+import orjson
 
-from common import Anime, get_env
+from common import get_env
 import database as db
 
 CLIENT_SESSION: aiohttp.ClientSession = None
+REQUEST_SEMAPHORE: asyncio.Semaphore = None
 
 ANILIST_API_URL = "https://graphql.anilist.co"
 
-ANILIST_FETCH_QUERY = """
-query ($page: Int, $formats: [MediaFormat]) {
-  Page(page: $page, perPage: 50) {
+ANILIST_FORMATS = ["TV", "TV_SHORT", "MOVIE","OVA", "ONA", "SPECIAL", "MUSIC"]
+
+# fields requested for every page of anime data
+ANILIST_PAGE_FIELDS = """
     pageInfo {
       lastPage
     }
@@ -33,78 +38,209 @@ query ($page: Int, $formats: [MediaFormat]) {
       genres
       averageScore
     }
-  }
-}
+"""
+
+# fields requested for dormant pages (no recent animes) that had a full update recently.
+# Titles, covers and genres of old animes rarely change, so only the fields that may
+# still change are requested
+ANILIST_LIGHT_PAGE_FIELDS = """
+    pageInfo {
+      lastPage
+    }
+    media(format_in: $formats) {
+      id
+      idMal
+      format
+      status
+      seasonYear
+      averageScore
+    }
+"""
 
+# staging table used to COPY anime batches. It is created once per connection and
+# emptied on every commit so that the statements using it stay prepared
+# in the connection statement cache
+ANIME_STAGE_TABLE_QUERY = """
+CREATE TEMP TABLE IF NOT EXISTS anime_stage (
+    anilist_id INTEGER PRIMARY KEY,
+    title TEXT,
+    cover TEXT,
+    format_id INTEGER,
+    release_year INTEGER,
+    status_id INTEGER,
+    score DOUBLE PRECISION,
+    mal_id INTEGER
+) ON COMMIT DELETE ROWS
 """
 
+db.add_connection_setup(ANIME_STAGE_TABLE_QUERY)
+
 logger = logging.getLogger(__name__)
 
+_ONE_WEEK = datetime.timedelta(weeks=1)
+
+# anilist format/status code -> database id. Loaded once at startup
+_FORMAT_IDS = {}
+_STATUS_IDS = {}
+
+# anilist genre name -> normalized and interned genre name.
+# anilist only uses a few genres so this never grows large
+_GENRE_NORMALIZE = {}
+
 ################################################################################
 # data structure helpers
 
+def _validate_release_year(release_year):
+    """Clamp anilist season year to the oldest supported year"""
+    if release_year is not None and release_year < 1940:
+        return 1940
+    return release_year
+
+
+def _normalize_score(average_score) -> float:
+    """Convert anilist average score (0-100, may be missing) to a 0-1 score"""
+    score = (average_score or 0) / 100
+    return min(max(score, 0), 1)
+
+
 class AnilistAnimeDataBatch:
-    """Class representing a bulk/batched insert into the database"""
+    """Class representing a bulk/batched insert into the database.
+
+    Data is stored column-wise so that each column can be sent to postgres
+    as a single array and expanded with unnest().
+    """
 
     def __init__(self) -> None:
-        self.genre_cache = {} # use this cache to check duplicates
-        self.bulk_anime = []
+        self.genre_cache = set() # use this cache to check duplicates
+
+        # anime columns
         self.bulk_anilist_ids = []
+        self.bulk_titles = []
+        self.bulk_covers = []
+        self.bulk_format_ids = []
+        self.bulk_release_years = []
+        self.bulk_status_ids = []
+        self.bulk_scores = []
+        self.bulk_mal_ids = []
+
+        # genres and anime-genre associations
         self.bulk_genre = []
-        self.bulk_anime_genre = []
+        self.bulk_anime_genre_ids = []
+        self.bulk_anime_genre_names = []
 
     
-    def append(self, anime: Anime):
-        anime.validate()
-        # anime tuple tu insert
-        self.bulk_anime.append(
-            (
-                anime.anilist,
-                anime.title,
-                anime.cover_url,
-                anime.format,
-                anime.release_year,
-                anime.status,
-                anime.normalized_score,
-                anime.mal
-            )
-        )
-
-        # ids to use to remove genres associations
-        self.bulk_anilist_ids.append(
-            (anime.anilist, )
-        )
+    def append_raw(self, anime: dict):
+        """Append an anime as returned by anilist api (see query above to see the required fields)"""
+        anilist_id = anime["id"]
+
+        # anime columns to insert
+        self.bulk_anilist_ids.append(anilist_id)
+        self.bulk_titles.append(anime["title"]["romaji"])
+        self.bulk_covers.append(anime["coverImage"]["large"])
+        self.bulk_format_ids.append(_FORMAT_IDS.get(anime["format"]))
+        self.bulk_release_years.append(_validate_release_year(anime["seasonYear"]))
+        self.bulk_status_ids.append(_STATUS_IDS.get(anime["status"]))
+        self.bulk_scores.append(_normalize_score(anime["averageScore"]))
+        self.bulk_mal_ids.append(anime["idMal"])
+
+        # new genere associations
+        for genre in anime["genres"]:
+            norm = _GENRE_NORMALIZE.get(genre)
+            if norm is None:
+                norm = sys.intern(genre.lower().replace(" ", "_"))
+                _GENRE_NORMALIZE[genre] = norm
+            genre = norm
 
-        # new genere associations tuples
-        for genre in anime.genres:
-            genre = genre.lower().replace(" ", "_")
-            
             # append genres only once for genre insert
             if genre not in self.genre_cache:
-                self.genre_cache[genre] = 1
-                self.bulk_genre.append((genre,))
+                self.genre_cache.add(genre)
+                self.bulk_genre.append(genre)
             
             # prepare anime-genre matches
-            self.bulk_anime_genre.append((anime.anilist, genre))
+            self.bulk_anime_genre_ids.append(anilist_id)
+            self.bulk_anime_genre_names.append(genre)
 
     def clear(self):
         self.genre_cache.clear()
-        self.bulk_anime.clear()
         self.bulk_anilist_ids.clear()
+        self.bulk_titles.clear()
+        self.bulk_covers.clear()
+        self.bulk_format_ids.clear()
+        self.bulk_release_years.clear()
+        self.bulk_status_ids.clear()
+        self.bulk_scores.clear()
+        self.bulk_mal_ids.clear()
         self.bulk_genre.clear()
-        self.bulk_anime_genre.clear()
+        self.bulk_anime_genre_ids.clear()
+        self.bulk_anime_genre_names.clear()
 
 
     def __len__(self):
         return len(self.bulk_anilist_ids)
 
     async def save(self):
-        """Save the whole list inside the database with an upsert operation"""
-        # also insert anime but preserve old id
-        await db.execute_many(
+        """Save the whole list inside the database with an upsert operation.
+
+        Animes, genres and their associations are saved inside a single transaction
+        """
+        if len(self) == 0:
+            return
+
+        async with db.database.acquire() as con:
+            async with con.transaction():
+                await self._save_animes(con)
+                await self._save_genres(con)
+                await self._save_associations(con)
+
+        logger.info("Inserted/Update %s animes", len(self.bulk_anilist_ids))
+
+    async def _save_animes(self, con):
+        """Copy animes into the staging table and upsert them from there"""
+        await con.copy_records_to_table(
+            "anime_stage",
+            records=zip(
+                self.bulk_anilist_ids,
+                self.bulk_titles,
+                self.bulk_covers,
+                self.bulk_format_ids,
+                self.bulk_release_years,
+                self.bulk_status_ids,
+                self.bulk_scores,
+                self.bulk_mal_ids
+            ),
+            columns=[
+                "anilist_id",
+                "title",
+                "cover",
+                "format_id",
+                "release_year",
+                "status_id",
+                "score",
+                "mal_id"
+            ]
+        )
+
+        # update existing animes first and insert only the new ones, so that
+        # only new animes take an id from the identity column
+        await con.execute(
+            """
+            UPDATE animes SET
+                title=a.title,
+                anilist_cover=a.cover,
+                format_id=a.format_id,
+                release_year=a.release_year,
+                status_id=a.status_id,
+                anilist_normalized_score=a.score,
+                mal_id=a.mal_id,
+                updated_at=NOW()
+            FROM anime_stage a
+            WHERE animes.anilist_id = a.anilist_id
+            """
+        )
+
+        await con.execute(
             """
             INSERT INTO animes (
-                id,
                 anilist_id,
                 title,
                 anilist_cover,
@@ -116,62 +252,62 @@ class AnilistAnimeDataBatch:
                 created_at,
                 updated_at
                 )
-            VALUES ( 
-                (SELECT coalesce(max(id), 0) + 1 FROM animes),
-                $1,
-                $2,
-                $3,
-                (SELECT id FROM anime_formats WHERE anilist = $4),
-                $5,
-                (SELECT id FROM anime_air_statuses WHERE anilist = $6),
-                $7,
-                $8,
+            SELECT
+                a.anilist_id,
+                a.title,
+                a.cover,
+                a.format_id,
+                a.release_year,
+                a.status_id,
+                a.score,
+                a.mal_id,
                 NOW(),
                 NOW()
-            )
-            ON CONFLICT (anilist_id) DO UPDATE SET
-                anilist_id=EXCLUDED.anilist_id,
-                title=EXCLUDED.title,
-                anilist_cover=EXCLUDED.anilist_cover,
-                format_id=EXCLUDED.format_id,
-                release_year=EXCLUDED.release_year,
-                status_id=EXCLUDED.status_id,
-                anilist_normalized_score=EXCLUDED.anilist_normalized_score,
-                mal_id=EXCLUDED.mal_id,
-                updated_at=EXCLUDED.updated_at
-            """,
-            self.bulk_anime
+            FROM anime_stage a
+            WHERE NOT EXISTS (SELECT 1 FROM animes WHERE anilist_id = a.anilist_id)
+            ORDER BY a.anilist_id
+            ON CONFLICT (anilist_id) DO NOTHING
+            """
         )
 
-
-        # insert new genres
-        await db.execute_many(
+    async def _save_genres(self, con):
+        """Insert missing genres"""
+        # insert in a fixed order: concurrent batches adding the same new genres
+        # in different orders would deadlock on the unique index
+        await con.execute(
             """
-            INSERT INTO genres (name) VALUES ($1)
+            INSERT INTO genres (name) SELECT unnest($1::text[]) AS name ORDER BY name
             ON CONFLICT (name) DO NOTHING
             """,
             self.bulk_genre
         )
-        
-        # remove old genres associations to let the new ones become the new genres
-        await db.execute_many (
-            """DELETE from anime_genres WHERE anime_id = (SELECT id FROM animes WHERE anilist_id = $1)""",
-            self.bulk_anilist_ids
-        )
 
-        # insert new genre associations
-        await db.execute_many(
+    async def _save_associations(self, con):
+        """Update anime-genre associations. Requires animes and genres to be saved"""
+        # insert the new pairs and remove the pairs that are no longer present
+        # for the animes in this batch
+        await con.execute(
             """
-            INSERT INTO anime_genres (anime_id, genre_id) VALUES (
-                (SELECT id FROM animes WHERE anilist_id = $1),
-                (SELECT id FROM genres WHERE name = $2)
-            ) ON CONFLICT (anime_id, genre_id) DO NOTHING
+            WITH new_pairs AS (
+                SELECT a.id AS anime_id, g.id AS genre_id
+                FROM unnest($1::int[], $2::text[]) AS t(anilist_id, genre)
+                JOIN animes a ON a.anilist_id = t.anilist_id
+                JOIN genres g ON g.name = t.genre
+            ), removed AS (
+                DELETE FROM anime_genres ag
+                USING anime_stage s, animes a
+                WHERE ag.anime_id = a.id
+                    AND a.anilist_id = s.anilist_id
+                    AND (ag.anime_id, ag.genre_id) NOT IN (SELECT anime_id, genre_id FROM new_pairs)
+            )
+            INSERT INTO anime_genres (anime_id, genre_id)
+            SELECT anime_id, genre_id FROM new_pairs
+            ON CONFLICT (anime_id, genre_id) DO NOTHING
             """,
-            self.bulk_anime_genre
+            self.bulk_anime_genre_ids,
+            self.bulk_anime_genre_names
         )
 
-        logging.info("Inserted/Update %s animes", len(self.bulk_anime))
-
 
 ################################################################################
 # initialization
@@ -179,7 +315,25 @@ class AnilistAnimeDataBatch:
 def _alloc_client_session_if_missing():
     global CLIENT_SESSION
     if CLIENT_SESSION is None:
-        CLIENT_SESSION = aiohttp.ClientSession()
+        # all requests go to anilist: keep its connections and dns resolution cached
+        connector = aiohttp.TCPConnector(
+            limit_per_host=int(get_env("MAKI_UpdaterMaxConcurrentRequests", 4)),
+            ttl_dns_cache=600,
+            keepalive_timeout=300,
+            enable_cleanup_closed=True
+        )
+        CLIENT_SESSION = aiohttp.ClientSession(
+            connector=connector,
+            # limit each socket operation instead of the whole request, which
+            # may fetch many pages
+            timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=120)
+        )
+
+
+def _alloc_request_semaphore_if_missing():
+    global REQUEST_SEMAPHORE
+    if REQUEST_SEMAPHORE is None:
+        REQUEST_SEMAPHORE = asyncio.Semaphore(int(get_env("MAKI_UpdaterMaxConcurrentRequests", 4)))
 
 
 async def _create_tracking_table():
@@ -187,11 +341,81 @@ async def _create_tracking_table():
         """
         CREATE TABLE IF NOT EXISTS anilist_update_tracking (
             page INTEGER PRIMARY KEY,
-            next_scheduled_update TIMESTAMP DEFAULT NOW()
+            next_scheduled_update TIMESTAMPTZ DEFAULT NOW(),
+            last_full_update TIMESTAMPTZ,
+            latest_year INTEGER
         );
+
+        ALTER TABLE anilist_update_tracking ADD COLUMN IF NOT EXISTS last_full_update TIMESTAMPTZ;
+        ALTER TABLE anilist_update_tracking ADD COLUMN IF NOT EXISTS latest_year INTEGER;
         """
     )
 
+    # tables created before timezone aware updates used a naive timestamp
+    await db.execute(
+        """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                    AND table_name = 'anilist_update_tracking'
+                    AND column_name = 'next_scheduled_update'
+                    AND data_type = 'timestamp without time zone'
+            ) THEN
+                ALTER TABLE anilist_update_tracking ALTER COLUMN next_scheduled_update TYPE TIMESTAMPTZ;
+            END IF;
+        END
+        $$;
+        """
+    )
+
+
+async def _migrate_anime_ids_to_identity():
+    """Let postgres generate anime ids with an identity column instead of computing max(id) + 1.
+    Does nothing if the column is already an identity column"""
+    await db.execute(
+        """
+        DO $$
+        DECLARE
+            serial_sequence TEXT;
+            next_id BIGINT;
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                    AND table_name = 'animes'
+                    AND column_name = 'id'
+                    AND is_identity = 'YES'
+            ) THEN
+                serial_sequence := pg_get_serial_sequence('animes', 'id');
+                ALTER TABLE animes ALTER COLUMN id DROP DEFAULT;
+
+                -- a SERIAL sequence would stay owned by the column and shadow the identity one
+                IF serial_sequence IS NOT NULL THEN
+                    EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', serial_sequence);
+                END IF;
+
+                ALTER TABLE animes ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+
+                -- continue after the ids already in use
+                SELECT coalesce(max(id), 0) + 1 INTO next_id FROM animes;
+                EXECUTE format('ALTER TABLE animes ALTER COLUMN id RESTART WITH %s', next_id);
+            END IF;
+        END
+        $$;
+        """
+    )
+
+
+async def _load_anime_lookups():
+    """Load the ids of anime formats and air statuses. Both tables are small and never change"""
+    formats = await db.fetch_all("SELECT anilist, id FROM anime_formats")
+    _FORMAT_IDS.update({row["anilist"]: row["id"] for row in formats})
+
+    statuses = await db.fetch_all("SELECT anilist, id FROM anime_air_statuses")
+    _STATUS_IDS.update({row["anilist"]: row["id"] for row in statuses})
+
 ################################################################################
 # page management
 
@@ -200,28 +424,41 @@ async def _get_last_page() -> int:
     return await db.fetch_value( "SELECT COUNT(page) FROM anilist_update_tracking")
 
 
-async def _get_page_to_fetch() -> int:
-    """Chose the best page to fetch from anilist api
+async def _get_pages_to_fetch(count: int) -> list:
+    """Chose the best pages to fetch from anilist api
+
+    Args:
+        count: maximum number of pages to return
 
     Returns
-        page number to fetch
+        list of (page number, full update) tuples to fetch, most urgent first.
+        Full update is true if all the anime fields of the page must be fetched
     """
 
-    page = await db.fetch_value(
+    # pages are fully updated unless they are dormant (latest anime at least two
+    # years old) and had a full update in the last 180 days
+    rows = await db.fetch_all(
         """
-        SELECT page
+        SELECT
+            page,
+            NOT coalesce(
+                latest_year < EXTRACT(YEAR FROM NOW()) - 1
+                    AND last_full_update > NOW() - INTERVAL '180 days',
+                FALSE
+            ) AS full_update
         FROM anilist_update_tracking
         WHERE next_scheduled_update - NOW() < INTERVAL '1 day'
         ORDER BY next_scheduled_update - NOW()
-        LIMIT 1
-        """
+        LIMIT $1
+        """,
+        count
     )
 
     # return 1 only if no update has ever been run (page count == 0)
-    if page is None and await _get_last_page() == 0: 
-        return 1
+    if len(rows) == 0 and await _get_last_page() == 0: 
+        return [(1, True)]
     else:
-        return page
+        return [(row["page"], row["full_update"]) for row in rows]
 
 
 
@@ -231,45 +468,67 @@ async def _add_untracked_pages(pages_available: int):
     Args:
         pages_available: number of pages on anilist api that are available
     """
-    bulk_pages = []
-    last_known_page = await _get_last_page()
-    for page in range(pages_available - last_known_page):
-        # +1 because pages start at one
-        bulk_pages.append((last_known_page + page + 1, ))
-
-    if len(bulk_pages) == 0:
-        logger.info("No new pages detected")
-        return
-
-    await db.execute_many(
+    # pages start at one, add all pages after the last known one
+    status = await db.execute(
         """
-        INSERT INTO anilist_update_tracking (page) VALUES ($1)
+        INSERT INTO anilist_update_tracking (page)
+        SELECT g FROM generate_series(
+            (SELECT coalesce(max(page), 0) + 1 FROM anilist_update_tracking),
+            $1
+        ) g
+        ON CONFLICT (page) DO NOTHING
         """,
-        bulk_pages
+        pages_available
     )
 
+    if status == "INSERT 0 0":
+        logger.info("No new pages detected")
 
-async def _set_page_scheduled_update(page_number:int, latest_anime_year:int):
+
+async def _set_page_scheduled_update(page_number:int, latest_anime_year:int, full_update:bool):
     """Calculate and se the new update time for the specified page based on the latest anime in the page
     
     Args:
         page_number: page number
         last_anime_year: year of the latest anime found in the specified page
+        full_update: whether all the anime fields of the page have been updated
     """
 
-    now = datetime.datetime.now()
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    known_year = None if latest_anime_year == -1 else latest_anime_year
 
     if latest_anime_year == -1:
         latest_anime_year = now.year - 4 # if no year recheck next month
 
-    delta_weeks = datetime.timedelta(weeks=abs(latest_anime_year - now.year))
-    now += delta_weeks
+    next_update = now + _ONE_WEEK * abs(latest_anime_year - now.year)
+
+    await db.execute(
+        """
+        UPDATE anilist_update_tracking SET
+            next_scheduled_update = $1,
+            last_full_update = CASE WHEN $3 THEN NOW() ELSE last_full_update END,
+            latest_year = $4
+        WHERE page = $2
+        """,
+        next_update, page_number, full_update, known_year
+    )
+
+
+async def _request_full_update(page_number:int):
+    """Schedule a full update of the specified page for the next update tick
 
+    Args:
+        page_number: page number
+    """
     await db.execute(
         """
-        UPDATE anilist_update_tracking SET next_scheduled_update = $1 WHERE page = $2
+        UPDATE anilist_update_tracking SET
+            next_scheduled_update = NOW(),
+            last_full_update = NULL
+        WHERE page = $1
         """,
-        now, page_number
+        page_number
     )
 
 ################################################################################
@@ -287,27 +546,18 @@ async def insert_animes(animes) -> int:
     """
     latest_year = -1
 
+    if len(animes) == 0:
+        return latest_year
+
     animeBatch = AnilistAnimeDataBatch()
 
     for anime in animes:
+        animeBatch.append_raw(anime)
 
-        a = Anime(
-                anilist=anime["id"],
-                title=anime["title"]["romaji"],
-                mal=anime["idMal"],
-                cover_url= anime["coverImage"]["large"],
-                format=anime["format"],
-                release_year= anime["seasonYear"],
-                status= anime["status"],
-                normalized_score= anime["averageScore"] / 100,
-                genres=anime["genres"]
-            )
-
-        animeBatch.append(a)
+        release_year = anime["seasonYear"]
+        if release_year is not None and release_year > latest_year:
+            latest_year = release_year
 
-        if a.release_year is not None and a.release_year > latest_year:
-            latest_year = a.release_year
-        
     await animeBatch.save()
 
     logger.info("Updated %d animes", len(animes))   
@@ -315,44 +565,208 @@ async def insert_animes(animes) -> int:
     return latest_year
 
 
-async def fetch_anime_data():
-    """Update/Insert anime based on anilist id. Does nothing if id is wrong
+async def update_anime_stats(animes) -> tuple:
+    """Update the fields fetched by the light query for animes already in the database
+
+    Args:
+        animes: array of anime json fetched from anilist api (see ANILIST_LIGHT_PAGE_FIELDS)
+
+    Returns:
+        Tuple of latest release year of the animes (-1 if no latest year is known) and
+        whether all the animes were found in the database. Missing animes are not inserted
     """
+    latest_year = -1
 
-    logger.info("Fetching anime data...")
+    if len(animes) == 0:
+        return latest_year, True
 
-    page_to_request = await _get_page_to_fetch()
+    anilist_ids = []
+    mal_ids = []
+    format_ids = []
+    release_years = []
+    status_ids = []
+    scores = []
 
-    if page_to_request is None:
-        logger.info("No data requires update. Skipping this update tick")
-        return
+    for anime in animes:
+        anilist_ids.append(anime["id"])
+        mal_ids.append(anime["idMal"])
+        format_ids.append(_FORMAT_IDS.get(anime["format"]))
+        release_years.append(_validate_release_year(anime["seasonYear"]))
+        status_ids.append(_STATUS_IDS.get(anime["status"]))
+        scores.append(_normalize_score(anime["averageScore"]))
+
+        release_year = anime["seasonYear"]
+        if release_year is not None and release_year > latest_year:
+            latest_year = release_year
+
+    status = await db.execute(
+        """
+        UPDATE animes SET
+            mal_id=a.mal_id,
+            format_id=a.format_id,
+            release_year=a.release_year,
+            status_id=a.status_id,
+            anilist_normalized_score=a.score,
+            updated_at=NOW()
+        FROM unnest(
+            $1::int[],
+            $2::int[],
+            $3::int[],
+            $4::int[],
+            $5::int[],
+            $6::float8[]
+        ) AS a(anilist_id, mal_id, format_id, release_year, status_id, score)
+        WHERE animes.anilist_id = a.anilist_id
+        """,
+        anilist_ids,
+        mal_ids,
+        format_ids,
+        release_years,
+        status_ids,
+        scores
+    )
 
-    logger.info("Updating anilist page: %d", page_to_request)
+    # status is "UPDATE <rows>"
+    updated = int(status.split()[-1])
+    logger.info("Updated stats of %d animes", updated)
 
-    # make a api request to anilist api to fetch a page of anime data
+    return latest_year, updated == len(animes)
+
+
+def _build_multipage_query(full_updates: tuple) -> str:
+    """Build a graphql query that fetches many pages at once.
+    Page i (starting from 1) is fetched using the variable $pi and returned with the alias ai
+
+    Args:
+        full_updates: for each page requested by the query, whether all the anime fields are requested
+    """
+    variables = "".join(f"$p{i}: Int, " for i in range(1, len(full_updates) + 1))
+    pages = "".join(
+        f"  a{i}: Page(page: $p{i}, perPage: 50) {{{ANILIST_PAGE_FIELDS if full else ANILIST_LIGHT_PAGE_FIELDS}  }}\n"
+        for i, full in enumerate(full_updates, 1)
+    )
+    return f"query ({variables}$formats: [MediaFormat]) {{\n{pages}}}\n"
+
+
+@functools.lru_cache(maxsize=64)
+def _build_request_prefix(full_updates: tuple) -> bytes:
+    """Build the serialized request body for a multipage query without the page variables.
+    The returned json is missing the closing braces of the variables and of the body
+
+    Args:
+        full_updates: for each page requested by the query, whether all the anime fields are requested
+    """
     request_data = {
-        "query": ANILIST_FETCH_QUERY,
-        "variables": { 
-            "page": page_to_request,
-            "formats": ["TV", "TV_SHORT", "MOVIE","OVA", "ONA", "SPECIAL", "MUSIC"]
+        "query": _build_multipage_query(full_updates),
+        "variables": {
+            "formats": ANILIST_FORMATS
         }
     }
+    # strip the closing braces of "variables" and of the body
+    return orjson.dumps(request_data)[:-2]
 
-    async with CLIENT_SESSION.post(ANILIST_API_URL, json = request_data) as resp:
-        if resp.status == 200:
-            data = await resp.json()
-            
-            # update anime data inside the database
-            latest_year = await insert_animes(data["data"]["Page"]["media"])
 
-            # update pages inside the db
-            await _add_untracked_pages(data["data"]["Page"]["pageInfo"]["lastPage"])
+async def _fetch_and_insert_pages(pages: list) -> int:
+    """Fetch pages of anime data from anilist api with a single request and save them inside the database
 
-            # calculate and update next page scheduled update
-            await _set_page_scheduled_update(page_to_request, latest_year)
+    Args:
+        pages: (page number, full update) tuples to fetch
 
+    Returns:
+        Number of pages available on anilist api or None if the request failed
+    """
+
+    # make a api request to anilist api to fetch the pages of anime data.
+    # only the page variables change between requests with the same shape
+    body = _build_request_prefix(tuple(full for _, full in pages))
+    body += b"".join(b',"p%d":%d' % (i, page) for i, (page, _) in enumerate(pages, 1))
+    body += b"}}"
+
+    # limit requests in flight to stay within anilist rate limits
+    async with REQUEST_SEMAPHORE:
+        try:
+            async with CLIENT_SESSION.post(
+                ANILIST_API_URL,
+                data=body,
+                headers={"Content-Type": "application/json"}
+            ) as resp:
+                if resp.status != 200:
+                    logger.error("Unable to reach anilist api")
+                    return None
+
+                data = orjson.loads(await resp.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error("Unable to reach anilist api: %r", e)
+            return None
+
+    if data.get("data") is None:
+        logger.error("Anilist api returned errors: %s", data.get("errors"))
+        return None
+
+    last_page = None
+    for i, (page, full_update) in enumerate(pages, 1):
+        page_data = data["data"][f"a{i}"]
+
+        last_page = page_data["pageInfo"]["lastPage"]
+
+        # update anime data inside the database
+        if full_update:
+            latest_year = await insert_animes(page_data["media"])
         else:
-            logger.error("Unable to reach anilist api")
+            latest_year, all_found = await update_anime_stats(page_data["media"])
+
+            if not all_found:
+                # new animes need all their fields, fetch the whole page on the next tick
+                logger.info("New animes found in page %d, scheduling a full update", page)
+                await _request_full_update(page)
+                continue
+
+        # calculate and update next page scheduled update
+        await _set_page_scheduled_update(page, latest_year, full_update)
+
+    return last_page
+
+
+async def fetch_anime_data():
+    """Update/Insert anime based on anilist id. Does nothing if id is wrong
+    """
+
+    logger.info("Fetching anime data...")
+
+    pages_to_request = await _get_pages_to_fetch(int(get_env("MAKI_UpdaterPagesPerUpdate", 4)))
+
+    if len(pages_to_request) == 0:
+        logger.info("No data requires update. Skipping this update tick")
+        return
+
+    logger.info("Updating anilist pages: %s", [page for page, _ in pages_to_request])
+
+    # group pages so that each request fetches many pages at once.
+    # a failed group only skips its own pages, they are retried on the next tick
+    pages_per_request = int(get_env("MAKI_UpdaterPagesPerRequest", 2))
+    groups = [
+        pages_to_request[i:i + pages_per_request]
+        for i in range(0, len(pages_to_request), pages_per_request)
+    ]
+    results = await asyncio.gather(
+        *[_fetch_and_insert_pages(group) for group in groups],
+        return_exceptions=True
+    )
+
+    last_pages = []
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            logger.error(
+                "Unable to update anilist pages %s",
+                [page for page, _ in group],
+                exc_info=result
+            )
+        elif result is not None:
+            last_pages.append(result)
+
+    # update pages inside the db
+    if len(last_pages) > 0:
+        await _add_untracked_pages(max(last_pages))
 
 
 ################################################################################
@@ -361,7 +775,10 @@ async def fetch_anime_data():
 async def periodically_update_anime_data():
     """Background task that updates anime data"""
     _alloc_client_session_if_missing()
+    _alloc_request_semaphore_if_missing()
     await _create_tracking_table()
+    await _migrate_anime_ids_to_identity()
+    await _load_anime_lookups()
 
     try:
         while True:
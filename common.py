@@ -1,31 +1,6 @@
-from dataclasses import dataclass
 import logging
 import os
-from typing import List
 
-@dataclass
-class Anime:
-    """
-    Model representing an anime in the database
-    """
-    anilist: int
-    mal: int
-    title: str
-    cover_url: str
-    format: str
-    status: str
-    genres: List[str]
-    release_year: int
-    normalized_score: float
-
-    def validate(self):
-        if self.release_year is not None and self.release_year < 1940:
-            self.realease_year = 1940
-        
-        self.normalized_score = min(max(self.normalized_score, 0), 1)
-
-
-    
 ################################################################################
 # utils
 
@@ -5,14 +5,36 @@ import asyncpg
 
 database: asyncpg.Pool = None
 
+# queries executed once on every new connection of the pool
+_connection_setup_queries = []
+
 
 async def connect():
     """Connect to postgres"""
     global database
-    database = await asyncpg.create_pool(get_env("MAKI_UpdaterDatabaseConnection"), min_size=1, max_size=10)
+    database = await asyncpg.create_pool(
+        get_env("MAKI_UpdaterDatabaseConnection"),
+        min_size=int(get_env("MAKI_UpdaterDatabasePoolMinSize", 4)),
+        max_size=int(get_env("MAKI_UpdaterDatabasePoolMaxSize", 20)),
+        # keep idle connections alive between update ticks
+        max_inactive_connection_lifetime=int(get_env("MAKI_UpdaterDatabaseIdleTimeoutSeconds", 60 * 60)),
+        init=_init_connection
+    )
     logging.info("Connected to sql database")
 
 
+async def _init_connection(connection: asyncpg.Connection):
+    """Prepare a new pool connection running all the registered setup queries"""
+    for query in _connection_setup_queries:
+        await connection.execute(query)
+
+
+def add_connection_setup(query: str):
+    """Register a query to run once on every new connection (e.g. session temp tables).
+    Must be called before connect()"""
+    _connection_setup_queries.append(query)
+
+
 async def disconnect():
     """Disconnect from postgres"""
     await database.close()
@@ -24,8 +46,8 @@ async def disconnect():
 
 
 async def execute(query: str , *args):
-    """Execute query without any returned value"""
-    await database.execute(query, *args )
+    """Execute query without any returned row. Returns the command status (e.g. "INSERT 0 1")"""
+    return await database.execute(query, *args )
 
 
 
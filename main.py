@@ -6,6 +6,13 @@ import anilistdataupdater as adu
 
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s - %(module)s@%(funcName)s: %(message)s")
 
+# use the faster uvloop event loop when available (not supported on windows)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    logging.info("uvloop not available, using default asyncio event loop")
+
 
 async def run():
     await db.connect()